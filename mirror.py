@@ -1,21 +1,43 @@
+import os
 import sys
+import json
+import time
 import uuid
 import string
+import hashlib
 import logging
-import tomllib
+import pathlib
+import threading
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
 from shutil import rmtree
 from functools import cache
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
 from dataclasses import dataclass
 from urllib.parse import urlparse
-from subprocess import run, CalledProcessError, STDOUT
+from subprocess import run, Popen, CalledProcessError, PIPE, DEVNULL, STDOUT
 
 
 logging.getLogger().setLevel(logging.INFO)
 
+# Remote heads are kept on disk for a short while, so rapid re-runs skip ls-remote:
+_DISK_CACHE = pathlib.Path(os.environ.get("MIRROR_CACHE", "/tmp/mirror-heads"))
+_DISK_CACHE_TTL = 30
+
+# Remote heads fetched by this process, see get_remote_heads and invalidate_remote_heads:
+_heads_cache: dict[str, dict[str, str] | None] = {}
+
+
+# Config keys of a [mirror.name] block, in MirrorJob field order:
+_CONFIG_KEYS = ("from-repo", "from-branch", "to-repo", "to-branch")
+
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MirrorJob:
     name: str
     from_repo: str
@@ -24,39 +46,88 @@ class MirrorJob:
     to_branch: str
 
 
+@cache
 def load_config(filename: str = "mirror-config.toml") -> dict[str, MirrorJob]:
-    with open("mirror-config.toml", "rb") as f:
+    with open(filename, "rb") as f:
         data = tomllib.load(f)
 
     mirror_jobs: dict[str, MirrorJob] = {}
     for name, job_data in data['mirror'].items():
-        # Convert from-repo -> from_repo, etc for the dataclass:
-        args = {k.replace("-", "_"): v for k, v in job_data.items()}
-        mirror_jobs[name] = MirrorJob(name=name, **args)
+        mirror_jobs[name] = MirrorJob(name, *(job_data[key] for key in _CONFIG_KEYS))
 
     return mirror_jobs
 
 
-@cache
+def _disk_cache_file(url: str) -> pathlib.Path:
+    return _DISK_CACHE / hashlib.sha256(url.encode()).hexdigest()
+
+
 def get_remote_heads(url: str) -> dict[str, str] | None:
+    if url not in _heads_cache:
+        _heads_cache[url] = _fetch_remote_heads(url)
+    return _heads_cache[url]
+
+
+def invalidate_remote_heads(url: str):
+    _heads_cache.pop(url, None)
+    _disk_cache_file(url).unlink(missing_ok=True)
+
+
+def _fetch_remote_heads(url: str) -> dict[str, str] | None:
+    cache_file = _disk_cache_file(url)
     try:
-        cmd = ["git", "ls-remote", "--heads", url]
-        p = run(cmd, capture_output=True, timeout=60, check=True)
+        if cache_file.stat().st_mtime > time.time() - _DISK_CACHE_TTL:
+            heads = json.loads(cache_file.read_text())
+            if isinstance(heads, dict):
+                logging.debug("Cached git heads for %s: %s", url, str(heads))
+                return heads
+    except (OSError, ValueError):
+        pass  # Missing, unreadable or corrupted cache, ask the server instead.
+
+    try:
+        # Protocol v2 lets the server filter by ref prefix instead of advertising
+        # every ref (e.g. GitLab's refs/merge-requests/*), never prompt for auth:
+        cmd = ["git", "-c", "protocol.version=2", "-c", "http.version=HTTP/2", "ls-remote", "--heads", url]
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        prefix = b"refs/heads/"
         heads = {}
-        for line in p.stdout.decode().splitlines():
-            hash, head = line.split("\t")
-            heads[head.strip().removeprefix("refs/heads/")] = hash.strip()
+
+        # Parse the heads as they arrive instead of buffering the whole output:
+        with Popen(cmd, stdout=PIPE, stderr=DEVNULL, env=env) as p:
+            timer = threading.Timer(60, p.kill)
+            timer.start()
+            try:
+                for line in p.stdout:
+                    hash, _, ref = line.rstrip(b"\n").partition(b"\t")
+                    if ref.startswith(prefix):
+                        heads[ref[len(prefix):].decode()] = hash.decode()
+                p.wait()
+            finally:
+                timer.cancel()
+
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, cmd)
 
         logging.debug("Git heads for %s: %s", url, str(heads))
-        return heads
     except CalledProcessError:
         logging.exception("Failed to fetch heads for: %s", url)
+        cache_file.unlink(missing_ok=True)
         return None
 
+    try:
+        _DISK_CACHE.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{uuid.uuid4()}.tmp")
+        tmp_file.write_text(json.dumps(heads))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logging.exception("Could not cache heads for: %s", url)
+
+    return heads
+
 
-def should_sync_job(job: MirrorJob) -> bool:
-    from_heads = get_remote_heads(job.from_repo)
-    to_heads = get_remote_heads(job.to_repo)
+def should_sync_job(job: MirrorJob, heads: dict[str, dict[str, str] | None]) -> bool:
+    from_heads = heads[job.from_repo]
+    to_heads = heads[job.to_repo]
 
     if from_heads is None or to_heads is None:
         logging.error("Could not fetch git heads, skipping job: %s", job.name)
@@ -81,24 +152,44 @@ def should_sync_job(job: MirrorJob) -> bool:
     return True
 
 
-def sync_repos(job: MirrorJob, repo_dir: str):
-    logging.info("[+] Processing job: %s", job.name)
+def write_git_config(repo_dir: str, sections: dict[str, dict[str, str | list[str]]]):
+    # Same as a series of `git config`/`git remote add` calls on a bare repo, without spawning git for each:
+    quote = lambda v: '"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    with open(os.path.join(repo_dir, "config"), "a") as f:
+        for section, values in sections.items():
+            f.write(f"[{section}]\n")
+            for key, value in values.items():
+                for v in [value] if isinstance(value, str) else value:
+                    f.write(f"\t{key} = {quote(v)}\n")
 
-    heads = get_remote_heads(job.to_repo)
-    if heads is None:
-        raise ValueError("wat")
 
+def sync_repos(jobs: list[MirrorJob], repo_dir: str) -> list[str]:
     git_cmd = ("git", "-C", repo_dir)
     xtras = {"check": True, "stderr": STDOUT}
+    by_from_repo = lambda x: x.from_repo
+    remotes, refspecs, sections = [], [], {}
+
+    # Set up one remote per source repo, tracking only the branches we need:
+    for i, (from_repo, from_jobs) in enumerate(groupby(sorted(jobs, key=by_from_repo), key=by_from_repo)):
+        from_jobs = list(from_jobs)
+        remote = f"source-{i}"
+        branches = dict.fromkeys(job.from_branch for job in from_jobs)
+        logging.info("[+] Processing job(s): %s", ", ".join(job.name for job in from_jobs))
+        logging.info("Downloading the source branch(es) from %s -> %s...", from_repo, ", ".join(branches))
+        sections[f'remote "{remote}"'] = {
+            "url": from_repo,
+            "fetch": [f"+refs/heads/{branch}:refs/remotes/{remote}/{branch}" for branch in branches],
+        }
+        remotes.append(remote)
+
+        # Make the target branches point to the mirrored objects, pushed later with the rest of the group:
+        refspecs.extend(f"refs/remotes/{remote}/{job.from_branch}:refs/heads/{job.to_branch}" for job in from_jobs)
 
-    # Set up and download missing objects from the source server:
-    logging.info("Downloading the source branch from %s -> %s...", job.from_repo, job.from_branch)
-    run([*git_cmd, "remote", "add", job.name, job.from_repo], timeout=30, **xtras)
-    run([*git_cmd, "fetch", job.name, job.from_branch], timeout=1800, **xtras)
+    write_git_config(repo_dir, sections)
 
-    # Make the target branch point to the mirrored object and force push it:
-    logging.info("Pushing to the target branch to %s -> %s...", job.to_repo, job.to_branch)
-    run([*git_cmd, "push", "--force", "origin", f"refs/remotes/{job.name}/{job.from_branch}:refs/heads/{job.to_branch}"], timeout=1800, **xtras)
+    # Download missing objects from all the source servers at once, fetch.parallel lets git overlap them:
+    run([*git_cmd, "fetch", "--multiple", *remotes], timeout=1800, **xtras)
+    return refspecs
 
 
 def generate_repo_path(url: str) -> str:
@@ -107,39 +198,111 @@ def generate_repo_path(url: str) -> str:
     return "".join(safe_chars) + "-" + str(uuid.uuid4())
 
 
+def remove_repo(repo_path: str):
+    # Deleting the objects can take a while, move the dir aside and delete it in the background.
+    # The thread is not a daemon, so the interpreter waits for it before exiting:
+    trash_path = f"{repo_path}.trash"
+    os.rename(repo_path, trash_path)
+
+    def remove():
+        try:
+            rmtree(trash_path)
+        except:
+            logging.exception("Could not clean up the job repo: %s", trash_path)
+
+    threading.Thread(target=remove, name=f"rmtree-{repo_path}").start()
+
+
+def sync_group(repo_url: str, jobs: list[MirrorJob], to_heads: dict[str, str]) -> bool:
+    logging.info("[+] Processing jobs for repo: %s", repo_url)
+    repo_path = generate_repo_path(repo_url)
+    group_failure = False
+
+    # Download the existing target branches first to minimize load on the source server.
+    # Only the mirrored branches are needed (no tags, no other branches), and their full
+    # history is kept so the source fetch and the push can negotiate against it.
+    # The repo is just a relay, so skip the working tree, and don't spend time checking
+    # or repacking objects in a repo that gets deleted right after the push:
+    logging.info("Downloading and configuring target repo %s to %s...", repo_url, repo_path)
+    run(["git", "init", "--bare", repo_path], timeout=30, check=True)
+    write_git_config(repo_path, {
+        'remote "origin"': {"url": repo_url, "fetch": "+refs/heads/*:refs/remotes/origin/*"},
+        "core": {"fsmonitor": "false"},
+        "gc": {"auto": "0"},
+        "maintenance": {"auto": "false"},
+        "transfer": {"fsckObjects": "false"},
+        "http": {"postBuffer": "157286400", "version": "HTTP/2"},
+        "fetch": {"parallel": "0", "fsckObjects": "false"},
+    })
+
+    # A new branch in an existing fork still needs some of the target history, take any head:
+    existing = [job.to_branch for job in jobs if job.to_branch in to_heads] or list(to_heads)[:1]
+    if existing:
+        run(["git", "-C", repo_path, "fetch", "--no-tags", "origin", *existing], timeout=1800, check=True)
+
+    refspecs = []
+    try:
+        refspecs = sync_repos(jobs, repo_path)
+    except:
+        logging.exception("Failed to process job(s): %s", ", ".join(job.name for job in jobs))
+        group_failure = True
+
+    # Force push all the fetched branches at once to negotiate with the target server only once,
+    # atomically so the target never ends up with only some of the branches updated:
+    if refspecs:
+        logging.info("Pushing %d branch(es) to %s...", len(refspecs), repo_url)
+        try:
+            run(["git", "-C", repo_path, "push", "--atomic", "--force", "origin", *refspecs], timeout=1800, check=True, stderr=STDOUT)
+        except:
+            logging.exception("Failed to push to the target repo: %s", repo_url)
+            group_failure = True
+        else:
+            # The target heads have changed now, don't let anyone trust the cached ones:
+            try:
+                invalidate_remote_heads(repo_url)
+            except OSError:
+                logging.exception("Could not invalidate the cached heads for: %s", repo_url)
+
+    if not group_failure:
+        # Leave the dir for debugging purposes:
+        try:
+            remove_repo(repo_path)
+        except:
+            logging.exception("Could not clean up the job repo: %s", repo_path)
+            # Don't set failures here, if the sync was successful, it's all good!
+
+    return not group_failure
+
+
 def main():
     global_failure = False
     by_repo_url = lambda x: x.to_repo
-    jobs = [job for job in load_config().values() if should_sync_job(job)]
+    all_jobs = load_config().values()
 
-    logging.info("Will sync %d job(s): %s", len(jobs), ", ".join(j.name for j in jobs))
+    # Fetch the heads of every repo in parallel, once per repo:
+    urls = {j.from_repo for j in all_jobs} | {j.to_repo for j in all_jobs}
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        heads = dict(zip(urls, executor.map(get_remote_heads, urls)))
 
-    # Group jobs by the target repo to clone the target repo only once.
-    for repo_url, jobs in groupby(sorted(jobs, key=by_repo_url), key=by_repo_url):
-        logging.info("[+] Processing jobs for repo: %s", repo_url)
-        repo_path = generate_repo_path(repo_url)
-        group_failure = False
+    jobs = [job for job in all_jobs if should_sync_job(job, heads)]
 
-        # Clone the target repository first to minimize load on the source server:
-        logging.info("Cloning and configuring target repo %s to %s...", repo_url, repo_path)
-        run(["git", "clone", "--no-checkout", repo_url, repo_path], timeout=1800, check=True)
-        run(["git", "-C", repo_path, "config", "http.postBuffer", "157286400"], timeout=30, check=True)
+    logging.info("Will sync %d job(s): %s", len(jobs), ", ".join(j.name for j in jobs))
+    if not jobs:
+        return 0  # The common case, everything is in sync and there is nothing to download.
 
-        for job in jobs:
+    # Group jobs by the target repo to clone the target repo only once.
+    # The groups are independent and mostly wait on the network, so process them concurrently:
+    groups = [(url, list(group)) for url, group in groupby(sorted(jobs, key=by_repo_url), key=by_repo_url)]
+    workers = min(len(groups), 3 * (os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(sync_group, url, group, heads[url]): url for url, group in groups}
+        for future, repo_url in futures.items():
             try:
-                sync_repos(job, repo_path)
+                if not future.result():
+                    global_failure = True
             except:
-                logging.exception("Failed to process job: %s", job.name)
+                logging.exception("Failed to process jobs for repo: %s", repo_url)
                 global_failure = True
-                group_failure = True
-
-        if not group_failure:
-            # Leave the dir for debugging purposes:
-            try:
-                rmtree(repo_path)
-            except:
-                logging.exception("Could not clean up the job repo: %s", repo_path)
-                # Don't set failures here, if the sync was successful, it's all good!
 
     return 1 if global_failure else 0
 